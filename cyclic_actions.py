@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 # Actions of cyclic groups on an algebraic curve.
@@ -18,78 +18,95 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
+from __future__ import division, print_function
+
 import argparse
+import array
+import functools
+import itertools
+import multiprocessing
+import operator
+import sys
+
+try:
+    from math import gcd
+except ImportError:
+    from fractions import gcd
 
 
 ### PRINTING FUNCTIONS ###
 
-def to_text(g, branch, results):
-    string = ""
-    string += "Faithful actions of non-trivial cyclic groups " \
-              "on a curve of genus %d" % g
-    if sum(branch) != 0:
-        string += " with:\n"
+def _ramification(symbols, ret):
+    parts = []
+    for idx_y, y in enumerate(ret):
+        if y == 1:
+            parts.append("(%s)" % symbols[idx_y])
+        elif y > 1:
+            parts.append("(%s)^%d" % (symbols[idx_y], y))
+    return "".join(parts)
+
+
+def to_text(g, branch, results, out):
+    parts = []
+    parts.append("Faithful actions of non-trivial cyclic groups "
+                 "on a curve of genus %d" % g)
+    if any(branch):
+        parts.append(" with:\n")
         last_branch = max((i for i in range(len(branch)) if branch[i] != 0))
         for i, f in enumerate(branch):
             if f != 0:
-                string += "  %d points with counterimage " \
-                          "with %d points" % (f, i + 1)
+                parts.append("  %d points with counterimage "
+                             "with %d points" % (f, i + 1))
                 if i != last_branch:
-                    string += ",\n"
-    string += ".\n\n"
-    for idx_r, r in enumerate(sorted(results)):
-        for idx_h, h in enumerate(sorted(results[r], reverse=True)):
-            for idx_x, x in enumerate(results[r][h][1]):
-                ci_string = ""
-                for idx_y, y in enumerate(x):
-                    counter_images = (r - results[r][h][0][idx_y])
-                    if y == 1:
-                        ci_string += "(%s)" % ("*" * counter_images)
-                    elif y > 1:
-                        ci_string += "(%s)^%d" % ("*" * counter_images, y)
-                string += "Z_%d, h = %d: %s\n" % (r, h, ci_string)
-        if idx_r != len(results) - 1:
-            string +=  "\n"
-    return string
-
-
-def to_latex(g, branch, results):
+                    parts.append(",\n")
+    parts.append(".\n\n")
+    out.write("".join(parts))
+    for idx_r, (r, results_r) in enumerate(
+            itertools.groupby(results, operator.itemgetter(0))):
+        if idx_r != 0:
+            out.write("\n")
+        for idx_x, (_, h, disc, ret) in enumerate(results_r):
+            if idx_x == 0:
+                symbols = ["*" * (r - d) for d in disc]
+            out.write("Z_%d, h = %d: %s\n" %
+                      (r, h, _ramification(symbols, ret)))
+
+
+def to_latex(g, branch, results, out):
     multirow = "\\multirow{%d}{*}{$%d$} "
-    string = ""
-    string += """\
+    out.write("""\
 \\begin{table}
   \\centering
   \\begin{tabular}{lll}
     \\toprule
     $r$ & $h$ & Additional ramification\\\\
     \\midrule[1pt]
-"""
-    for idx_r, r in enumerate(sorted(results)):
-        size_r = sum((len(results[r][x][1]) for x in results[r]))
-        for idx_h, h in enumerate(sorted(results[r], reverse=True)):
-            size_h = len(results[r][h][1])
-            for idx_x, x in enumerate(results[r][h][1]):
-                ci_string = ""
-                for idx_y, y in enumerate(x):
-                    counter_images = (r - results[r][h][0][idx_y])
-                    if y == 1:
-                        ci_string += "(%s)" % ("\\bullet" * counter_images)
-                    elif y > 1:
-                        ci_string += "(%s)^%d" % ("\\bullet" * counter_images, y)
-                string += "    "
+""")
+    for idx_r, (r, results_r) in enumerate(
+            itertools.groupby(results, operator.itemgetter(0))):
+        # We need the size of the block of r before writing it.
+        results_r = list(results_r)
+        if idx_r != 0:
+            out.write("    \\midrule\n")
+        symbols = ["\\bullet" * (r - d) for d in results_r[0][2]]
+        for idx_h, (h, results_h) in enumerate(
+                itertools.groupby(results_r, operator.itemgetter(1))):
+            results_h = list(results_h)
+            if idx_h != 0:
+                out.write("    \\cmidrule{2-3}\n")
+            for idx_x, (_, _, _, ret) in enumerate(results_h):
+                parts = []
+                parts.append("    ")
                 if idx_h == 0 and idx_x == 0:
-                    string += multirow % (size_r, r)
-                string += "& "
+                    parts.append(multirow % (len(results_r), r))
+                parts.append("& ")
                 if idx_x == 0:
-                    string +=  multirow % (size_h, h)
-                string += "& "
-                string += "$%s$\\\\\n" % ci_string
-            if idx_h != len(results[r]) - 1:
-                string +=  "    \\cmidrule{2-3}\n"
-        if idx_r != len(results) - 1:
-            string +=  "    \\midrule\n"
+                    parts.append(multirow % (len(results_h), h))
+                parts.append("& ")
+                parts.append("$%s$\\\\\n" % _ramification(symbols, ret))
+                out.write("".join(parts))
     caption = "Cyclic groups acting on a curve of genus $%d$" % g
-    if sum(branch) != 0:
+    if any(branch):
         caption += " with"
         last_branch = max((i for i in range(len(branch)) if branch[i] != 0))
         for i, f in enumerate(branch):
@@ -99,118 +116,196 @@ def to_latex(g, branch, results):
                 if i != last_branch:
                     caption += ","
     caption += "."
-    string += """\
+    out.write("""\
     \\bottomrule
   \\end{tabular}
   \\caption{%s}
   \\label{tab:cyclic_group_actions}
 \\end{table}
-""" % caption
-    return string
+""" % caption)
 
 
 ### UTILITY FUNCTIONS ###
 
-def gcd(a, b):
-    """Return the gcd of a and b.
+def lcm(a, b):
+    """Return the lcm of a and b.
 
     a, b (int): integers.
 
-    return (int): the gcd of a and b.
+    return (int): the lcm of a and b.
 
     """
-    _gcd, tmp = a, b
-    while tmp != 0:
-        _gcd, tmp = tmp, _gcd % tmp
-    return _gcd
+    return a // gcd(a, b) * b
 
 
-def lcm(a, b):
-    """Return the lcm of a and b.
+def rows(flat, width):
+    """Iterate over the rows of a matrix stored by rows in a flat
+    array.
 
-    a, b (int): integers.
+    flat (array): the elements of the matrix.
+    width (int): the number of columns of the matrix.
 
-    return (int): the lcm of a and b.
+    yield ([int]): the rows of the matrix.
+
+    """
+    for i in range(0, len(flat), width):
+        yield flat[i:i + width].tolist()
+
+
+def divisors(n):
+    """Return the positive divisors of n.
+
+    n (int): a positive integer.
+
+    return ([int]): the divisors of n, in increasing order.
 
     """
-    return a * b / gcd(a, b)
+    # Factor n by trial division, stopping at the square root of what
+    # is left to factor, then multiply the prime powers together.
+    ret = [1]
+    p = 2
+    while p * p <= n:
+        if n % p == 0:
+            powers = []
+            power = 1
+            while n % p == 0:
+                n //= p
+                power *= p
+                powers.append(power)
+            ret += [d * q for d in ret for q in powers]
+        p += 1 if p == 2 else 2
+    if n > 1:
+        ret += [d * n for d in ret]
+    return sorted(ret)
+
+
+def totatives(n):
+    """Return the positive integers smaller than n and coprime with it.
+
+    n (int): a positive integer.
+
+    return ((int)): the totatives of n, in increasing order.
+
+    """
+    return tuple(i for i in range(1, n) if gcd(i, n) == 1)
 
 
 ### MAIN FUNCTIONS ###
 
+_discrepancies_cache = {}
+
+
 def discrepancies(r):
-    """Return a list of all possible contribution to the discrepancy
-    coming from a branch point in the quotient curve.
+    """Return a tuple of all possible contribution to the discrepancy
+    coming from a branch point in the quotient curve. Results are
+    memoized, since the same r are asked for again and again.
 
     r (int): the order of the cyclic group.
 
-    return ([int]): all possible contributions.
+    return ((int)): all possible contributions.
 
     """
-    ret = []
-    for i in xrange(2, r + 1):
-        if r % i == 0:
-            ret.append((i - 1) * r / i)
-    return ret
+    if r not in _discrepancies_cache:
+        _discrepancies_cache[r] = tuple((i - 1) * (r // i)
+                                        for i in divisors(r)[1:])
+    return _discrepancies_cache[r]
 
 
-def all_discrepancies(discrepancies, Q, start=0):
+def all_discrepancies(discrepancies, Qs):
     """Given the list of possible contributions to the discrepancy and
-    the discrepancy Q to reach, return a list of all coefficients of
-    the linear combinations of elements of discrepancies that sum up
-    to Q.
+    some discrepancies Q to reach, return for each Q a list of all
+    coefficients of the linear combinations of elements of
+    discrepancies that sum up to Q.
+
+    All the Q are solved together, with a table of the solutions using
+    only the discrepancies from the k-th on, for k going down to 0, so
+    that the solutions of common subproblems are computed only once.
+    The table is filled only for the values that are actually needed
+    to reach some Q.
 
     discrepancies ([int]): the list of possible contribution as
                            returned by discrepancies.
-    Q (int): the total discrepancy to reach.
-    start (int): used internally: we assume to use only discrepancies
-                                  starting from the index start.
+    Qs ([int]): the total discrepancies to reach.
 
-    return ([[int]]): the coefficients of the linear combination of
-                      discrepancies summing up to Q.
+    return ({int: [(int)]}): for each Q, the coefficients of the
+                             linear combination of discrepancies
+                             summing up to Q, in decreasing
+                             lexicographic order.
 
     """
-    elements_to_use = len(discrepancies) - start
-    if Q == 0:
-        return [[0] * elements_to_use]
-    elif elements_to_use <= 0:
-        return []
-    ret = []
-    curr = discrepancies[start]
-    for i in xrange(Q / curr, -1, -1):
-        r = all_discrepancies(discrepancies, Q - i * curr, start + 1)
-        for x in r:
-            ret.append([i] + x)
-    return ret
-
-
-def _ac_check(r, a, start=0, total=0):
-    """Helper function for ac_check. We can safely assign n_1 = 1
-    because in any case we can apply an automorphism of C_r sending
-    n_1 to 1.
+    Qs = [Q for Q in Qs if Q >= 0]
+    if not discrepancies:
+        return dict((Q, [()] if Q == 0 else []) for Q in Qs)
+    # needed[k] are the values that the discrepancies from the k-th on
+    # may have to sum up to.
+    needed = [set(Qs)]
+    for d in discrepancies[:-1]:
+        needed.append(set(q - i * d
+                          for q in needed[-1] for i in range(q // d + 1)))
+    # The coefficient of the last discrepancy is forced by the others.
+    d = discrepancies[-1]
+    table = dict((q, [(q // d,)] if q % d == 0 else [])
+                 for q in needed[-1])
+    for k in range(len(discrepancies) - 2, -1, -1):
+        d = discrepancies[k]
+        table = dict((q, [(i,) + x
+                          for i in range(q // d, -1, -1)
+                          for x in table[q - i * d]])
+                     for q in needed[k])
+    return table
+
+
+def _ac_degrees(r, a, totatives_r, cache):
+    """Helper function for ac_check, returning the set of all possible
+    degrees, modulo r, of the right side of the equation. We can
+    safely assign n_1 = 1 because in any case we can apply an
+    automorphism of C_r sending n_1 to 1.
+
+    The set is built adding one a_i at a time; the same few sets come
+    up again and again, so each step from a set and an a_i to the next
+    set is kept in cache.
 
     r (int): the size of the cyclic group.
     a ([int]): the a_i's in the equation.
-    start (int): the current position to assign.
-    total (int): the current total degree in the right of the equation.
+    totatives_r ({int: (int)}): the totatives of the divisors of r.
+    cache ({(frozenset, int): frozenset}): the steps already computed
+                                           for r.
 
-    return (bool): True if the degree equation has a solution.
+    return (frozenset): the possible degrees.
 
     """
-    if start >= len(a):
-        return total % r == 0
-    if start == 0:
-        return _ac_check(r, a, 1, r // a[0])
+    degrees = frozenset([r // a[0]])
+    for a_i in a[1:]:
+        key = (degrees, a_i)
+        if key not in cache:
+            step = r // a_i
+            cache[key] = frozenset((t + n * step) % r
+                                   for t in degrees
+                                   for n in totatives_r[a_i])
+        degrees = cache[key]
+    return degrees
+
+
+def branch_stabilizers(r, br):
+    """Return the orders of the stabilizers of the points over the
+    prescribed branch points, that is, the a_i's coming from br in the
+    equation of ac_check. They only depend on r and br, so they can be
+    computed once for each r.
+
+    r (int): the size of the cyclic group.
+    br ([int]): the prescribed branch points.
+
+    return ((int)): the a_i's coming from br, in decreasing order.
 
-    for i in xrange(1, a[start]):
-        if gcd(i, a[start]) == 1:
-            result = _ac_check(r, a, start + 1, total + i * r / a[start])
-            if result:
-                return True
-    return False
+    """
+    a = []
+    for idx_x, x in enumerate(br):
+        if r != idx_x + 1:
+            a += ([r // (idx_x + 1)] * x)
+    return tuple(sorted(a, reverse=True))
 
 
-def ac_check(r, br, disc, ret):
+def ac_check(r, a_br, disc, ret, totatives_r, cache):
     """Check a consequence of the abelian cover condition, that states
     that if there is an cyclic cover with point P_i with preimage
     stabilized by the subgroup of order of a_1, ..., a_k, then there
@@ -220,30 +315,90 @@ def ac_check(r, br, disc, ret):
     least when we pass to the degrees of the line bundles.
 
     r (int): the size of the cyclic group.
-    br ([int]): the prescribed branch points.
+    a_br ((int)): the a_i's of the prescribed branch points, as
+                  returned by branch_stabilizers.
     disc ([int]): the possible discrepancies;
     ret ([int]): the additional branch points relative to disc.
+    totatives_r ({int: (int)}): the totatives of the divisors of r.
+    cache ({(frozenset, int): frozenset}): cache for _ac_degrees, to
+                                           be shared by all the calls
+                                           with the same r.
 
     return (bool): True if the degree equation has a solution.
 
     """
+    # disc is increasing, hence so are the r / (r - disc[idx_x]):
+    # merge them in reverse order with a_br, already decreasing.
     a = []
-    for idx_x, x in enumerate(br):
-        if r != idx_x + 1:
-            a += ([r / (idx_x + 1)] * x)
-    for idx_x, x in enumerate(ret):
-        if r != idx_x + 1:
-            a += ([r / (r - disc[idx_x])] * x)
-    return _ac_check(r, sorted(a, reverse=True))
+    idx_br = 0
+    for idx_x in range(len(ret) - 1, -1, -1):
+        a_x = r // (r - disc[idx_x])
+        while idx_br < len(a_br) and a_br[idx_br] >= a_x:
+            a.append(a_br[idx_br])
+            idx_br += 1
+        a += [a_x] * ret[idx_x]
+    a += a_br[idx_br:]
+    if not a:
+        return True
+    if len(a) == 1:
+        # The degree is n_1 * r / a_1, with 0 < n_1 < a_1.
+        return False
+    return 0 in _ac_degrees(r, a, totatives_r, cache)
+
+
+def _solve_r(r, N, cp, branch):
+    """Compute the possible actions of Z_r; this is the body of the
+    main loop of run, independent for each r.
+
+    r (int): the order of the cyclic group.
+    N (int): the number of prescribed branch points.
+    cp (int): 2g - 2 plus the contribution of the prescribed branch
+              points.
+    branch ([int]): the prescribed branch points.
 
+    return ((int, {int: [(int), array]})): r and, for each h, the
+        discrepancies and the additional branch points, stored as a
+        flat array with a row of len(discrepancies) elements for each
+        solution (see rows).
 
-def run(g, branch):
-    """Main algorithm.
+    """
+    h_den = 2 * r
+    h_num = (2 - N) * r + cp
+
+    disc = discrepancies(r)
+    a_br = branch_stabilizers(r, branch)
+    # All the a_i's in ac_check are divisors of r.
+    totatives_r = dict((d, totatives(d)) for d in divisors(r))
+    ac_cache = {}
+
+    results_r = {}
+    # Q is h_num - h_den * h, updated as h decreases.
+    h_max, Q = divmod(h_num, h_den)
+    all_rets = all_discrepancies(disc, range(Q, h_num + 1, h_den))
+    for h in range(h_max, -1, -1):
+        for ret in all_rets[Q]:
+            if not ac_check(r, a_br, disc, ret, totatives_r, ac_cache):
+                continue
+            if h not in results_r:
+                results_r[h] = [disc, array.array("I")]
+            results_r[h][1].extend(ret)
+        Q += h_den
+    return r, results_r
+
+
+def run(g, branch, jobs=1):
+    """Main algorithm. Results are generated one at a time, ordered
+    by increasing r, then by decreasing h.
 
     g (int): genus of the curve above.
     branch ([int]): the i-th element is the number of points of the
                     quotient with (i+1) points in the counterimage.
-    latex (bool): whether to provide output in LaTeX format.
+    jobs (int): number of worker processes to use, or None for one
+                per CPU.
+
+    yield ((int, int, (int), [int])): r, h, the discrepancies and the
+                                      additional branch points relative
+                                      to them.
 
     """
     lcm_ = 1
@@ -264,26 +419,25 @@ def run(g, branch):
     elif (2 - N == 0):
         upper_limit = min(upper_limit, 2 * cp)
 
-    results = {}
-    for r in range(max(lcm_, 2), upper_limit + 1, lcm_):
-        h_den = 2 * r
-        h_num = (2 - N) * r + cp
-
-        disc = discrepancies(r)
-
-        for h in xrange(h_num / h_den, -1, -1):
-            Q = h_num - h_den * h
-            rets = all_discrepancies(disc, Q)
-            for ret in rets:
-                if not ac_check(r, branch, disc, ret):
-                    continue
-                if r not in results:
-                    results[r] = {}
-                if h not in results[r]:
-                    results[r][h] = [disc, []]
-                results[r][h][1].append(ret)
-
-    return results
+    r_values = range(max(lcm_, 2), upper_limit + 1, lcm_)
+    solve_r = functools.partial(_solve_r, N=N, cp=cp, branch=branch)
+
+    if jobs == 1:
+        solutions = (solve_r(r) for r in r_values)
+    else:
+        # Results must come in order to be streamed; the workers keep
+        # going on the next r while we wait for a slow one.
+        pool = multiprocessing.Pool(jobs)
+        solutions = pool.imap(solve_r, r_values)
+    try:
+        for r, results_r in solutions:
+            for h in sorted(results_r, reverse=True):
+                disc, rets = results_r[h]
+                for ret in rows(rets, len(disc)):
+                    yield r, h, disc, ret
+    finally:
+        if jobs != 1:
+            pool.terminate()
 
 
 def main():
@@ -300,16 +454,21 @@ def main():
                         "with i+1 points in the counterimage")
     parser.add_argument("-l", "--latex", action="store_true",
                         help="output also in LaTeX format")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes to use "
+                        "(0 for one per CPU)")
 
     args = parser.parse_args()
-    if (args.genus < 0 or any([x < 0 for x in args.branch])):
-        parser.usage()
+    if (args.genus < 0 or args.jobs < 0 or
+            any([x < 0 for x in args.branch])):
+        parser.print_usage()
         return
-    results = run(args.genus, args.branch)
+    results = run(args.genus, args.branch, args.jobs or None)
     print_function = to_text
     if args.latex:
         print_function = to_latex
-    print print_function(args.genus, args.branch, results)
+    print_function(args.genus, args.branch, results, sys.stdout)
+    print()
 
 
 if __name__ == "__main__":